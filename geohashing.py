@@ -1,17 +1,163 @@
 #!/usr/bin/env python3
 
 import datetime
-import requests
+import functools
+import json
+import math
+import os
+import queue
+import re
+import threading
+import time
 from hashlib import md5
 import sys
 import argparse
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, so the cache won't be locked
+    fcntl = None
+
 # Websites that return the Dow Jones index in plain text
 # The date can be appended to the URL in this format: %Y/%m/%d
 DOW_JONES_SOURCES = ["http://geo.crox.net/djia/", "http://www1.geo.crox.net/djia/",
                      "http://www2.geo.crox.net/djia/", "http://carabiner.peeron.com/xkcd/map/data/"]
+# Timeout for each blocking step of a request to a source, in seconds
+DOW_JONES_TIMEOUT = 3.0
+# How long to wait on a source before also querying the next one, in seconds
+DOW_JONES_HEDGE_DELAY = 0.3
+# How long to spend on all the sources combined, in seconds
+DOW_JONES_DEADLINE = 8.0
+# The most bytes read from a Dow Jones response
+DOW_JONES_MAX_BYTES = 64
+
+# Previously retrieved Dow Jones values, keyed by date
+CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                          "geohashing", "dow.json")
+
+# Scales a 64-bit integer to a fraction in [0, 1)
+_INV_2_64 = 1.0 / (1 << 64)
+
+
+def _lock(f, exclusive=False):
+    """Lock the open file `f` until it is closed, if the platform supports it."""
+
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def _read_cache():
+    """Returns the cached Dow Jones values as a dict, which is empty if there is no cache."""
+
+    try:
+        with open(CACHE_FILE) as f:
+            _lock(f)
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write_cache(date, dow_jones):
+    """Add the Dow Jones value for `date` to the cache. Failures are ignored."""
+
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, "a+") as f:
+            _lock(f, exclusive=True)
+            f.seek(0)
+            try:
+                cache = json.load(f)
+            except ValueError:  # Empty or corrupted
+                cache = {}
+            if not isinstance(cache, dict):  # Valid JSON, but not something this wrote
+                cache = {}
+            cache[date] = dow_jones
+            f.seek(0)
+            f.truncate()
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
+def _dow_jones_date(east=False, date=None):
+    """Returns the date whose Dow Jones value should be used, in %Y/%m/%d format."""
+
+    if date is None:
+        date = datetime.date.today()
+    if east:  # Subtract a day to make this 30W compliant
+        date += datetime.timedelta(days=-1)
+    # Formatted directly, as strftime is slow
+    return f"{date.year:04d}/{date.month:02d}/{date.day:02d}"
+
+
+def _is_number(value):
+    """Returns whether the string `value` is a valid number, such as a Dow Jones value."""
+
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _cached(func):
+    """Decorator for get_dow_jones that stores values in CACHE_FILE.
+
+    A Dow Jones value never changes once it's published, so cached values are
+    returned without touching the network.
+    """
+
+    @functools.wraps(func)
+    def wrapper(east=False, date=None):
+        key = _dow_jones_date(east, date)
+        cached = _read_cache().get(key)
+        if _is_number(cached):  # Skip anything that isn't a Dow Jones value
+            return cached
+        dow_jones = func(east, date)
+        if _is_number(dow_jones):
+            _write_cache(key, dow_jones)
+        return dow_jones
 
+    return wrapper
 
+
+def _fetch_dow_jones(url, deadline):
+    """Returns the Dow Jones value found at `url`, or None if it couldn't be retrieved.
+
+    The request is given up once `deadline`, a time.monotonic() value, has passed.
+    """
+
+    # Imported here as they're slow to load, and only needed when using the network
+    from http.client import HTTPException
+    from urllib.request import urlopen
+
+    budget = deadline - time.monotonic()
+    if budget <= 0:
+        return None
+    try:
+        with urlopen(url, timeout=min(DOW_JONES_TIMEOUT, budget)) as r:
+            if r.status != 200:
+                return None
+            # The response is a short ASCII number, anything longer is something else.
+            # It's read in pieces so a source sending it very slowly can't outlast the deadline.
+            body = b""
+            while len(body) <= DOW_JONES_MAX_BYTES:
+                if time.monotonic() >= deadline:
+                    return None
+                chunk = r.read1(DOW_JONES_MAX_BYTES + 1 - len(body))
+                if not chunk:
+                    break
+                body += chunk
+            if len(body) > DOW_JONES_MAX_BYTES:
+                return None
+            value = body.decode("ascii").strip()
+            return value if _is_number(value) else None
+    except (OSError, HTTPException, UnicodeDecodeError):
+        return None  # This source is offline or broken
+
+
+@_cached
 def get_dow_jones(east=False, date=None):
     """
     The date will be derived from the computer clock, but if it is manually supplied,
@@ -19,56 +165,145 @@ def get_dow_jones(east=False, date=None):
 
     Set `east` to true if your current location is East of -30 longitude.
     """
-    if date is None:
-        date = datetime.date.today()
-    if east:  # Subtract a day to make this 30W compliant
-        date += datetime.timedelta(days=-1)
-    
-    date = date.strftime("%Y/%m/%d")
-    for url in DOW_JONES_SOURCES:
+    date = _dow_jones_date(east, date)
+    # Query the sources in order, but don't wait on a slow one for long:
+    # after a short delay the next source is queried in parallel, and the
+    # first valid response wins.
+    # The requests run on daemon threads, so any still going once a value is
+    # found don't stop the program from exiting.
+    deadline = time.monotonic() + DOW_JONES_DEADLINE
+    urls = iter([url + date for url in DOW_JONES_SOURCES])
+    results = queue.Queue()
+
+    def start(url):
+        threading.Thread(target=lambda: results.put(_fetch_dow_jones(url, deadline)), daemon=True).start()
+
+    start(next(urls))
+    running = 1
+    while running:
+        budget = deadline - time.monotonic()
+        if budget <= 0:
+            break
         try:
-            r = requests.get(url + date, timeout=5)
-        except requests.exceptions.ReadTimeout:
-            continue  # Try another source, this one is offline
-        # Otherwise, check and return the result found
-        if r.status_code == 200:
-            return r.text.strip()
+            dow_jones = results.get(timeout=min(DOW_JONES_HEDGE_DELAY, budget))
+        except queue.Empty:
+            pass
+        else:
+            running -= 1
+            if dow_jones is not None:
+                return dow_jones
+        # Nothing useful yet, try another source as well
+        url = next(urls, None)
+        if url is not None and time.monotonic() < deadline:
+            start(url)
+            running += 1
 
     # All URLs have been tried and failed
     raise Exception("None of the programmed Dow Jones sources are online, or no data exists for your date yet.\nTry providing one manually.")
 
 
-def get_hash(east=False, date=None, dow_jones=None):
-    """Get the md5 hash.
+@functools.lru_cache(maxsize=32)
+def _date_prefix(date):
+    """Returns the start of the hashed string for `date`, as bytes."""
+
+    return f"{date.year:04d}-{date.month:02d}-{date.day:02d}-".encode()
+
+
+def _resolve(east, date, dow_jones):
+    """Returns (date, dow_jones), using the current values for any that are None."""
+
+    if date is None:
+        date = datetime.date.today()
+    if dow_jones is None:
+        dow_jones = get_dow_jones(east, date)
+    return date, dow_jones
+
+
+def _digest(date, dow_jones):
+    """Returns the raw md5 hash for an already resolved date and Dow Jones value."""
+
+    # The hash only derives coordinates, so FIPS restrictions don't apply
+    return md5(_date_prefix(date) + str(dow_jones).encode(), usedforsecurity=False).digest()
+
+
+def _digest_to_fractions(digest):
+    """Returns the two halves of a raw md5 hash as fractions in [0, 1), as (frac_lat, frac_lon)."""
+
+    return (int.from_bytes(digest[:8], "big") * _INV_2_64,
+            int.from_bytes(digest[8:], "big") * _INV_2_64)
+
+
+def _hash_to_fractions(date, dow_jones):
+    """Returns (frac_lat, frac_lon) for an already resolved date and Dow Jones value.
+
+    This is the core that all the geohash functions build on.
+    """
+
+    return _digest_to_fractions(_digest(date, dow_jones))
+
+
+def get_digest(east=False, date=None, dow_jones=None):
+    """Get the md5 hash as 16 raw bytes.
 
     dow_jones can be a string or number. If it is None, then the current value
     will be used.
     `date` will be derived from the computer clock, but if it is manually supplied,
     it must be in a datetime.date object.
+    """
+
+    return _digest(*_resolve(east, date, dow_jones))
+
+
+def get_hash(east=False, date=None, dow_jones=None):
+    """Get the md5 hash.
 
+    The arguments are the same as for get_digest.
     The hash will be returned as a hexadecimal string.
     """
 
-    if date is None:
-        date = datetime.date.today()
-    if dow_jones is None:
-        dow_jones = get_dow_jones(east, date)
-    # Reformat
-    dow_jones = str(dow_jones)
-    date = date.strftime("%Y-%m-%d")
+    return get_digest(east, date, dow_jones).hex()
+
+
+def _assemble(frac_lat, frac_lon, u_lat, u_lon):
+    """Returns (lat, lon), the hash fractions appended to the graticule."""
+
+    return (math.copysign(abs(int(u_lat)) + frac_lat, u_lat),
+            math.copysign(abs(int(u_lon)) + frac_lon, u_lon))
+
+
+@functools.lru_cache(maxsize=None)
+def _jit_assemble_many():
+    """Returns a Numba-compiled form of _assemble for 1D arrays, or None if Numba isn't installed.
+
+    The returned function takes (u_lats, u_lons, frac_lat, frac_lon) and writes
+    the results to frac_lat and frac_lon.
+    Numba is slow to import, so this only happens once bulk geohashing is used.
+    """
+
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, cache=True)
+    def assemble_many(u_lats, u_lons, frac_lat, frac_lon):
+        for i in prange(len(u_lats)):
+            frac_lat[i] = math.copysign(abs(int(u_lats[i])) + frac_lat[i], u_lats[i])
+            frac_lon[i] = math.copysign(abs(int(u_lons[i])) + frac_lon[i], u_lons[i])
 
-    return md5(date.encode() + b"-" + dow_jones.encode()).hexdigest()
+    return assemble_many
 
 
-def hash_to_location(u_lat, u_lon, md5_hash):
-    """Returns (lat, lon) as floats."""
+def hash_to_location(u_lat, u_lon, md5_digest):
+    """Returns (lat, lon) as floats.
 
-    h1 = md5_hash[:16]
-    h2 = md5_hash[16:]
-    # Append the base10 conversion as decimals
-    lat = str(int(u_lat)) + str(float.fromhex("0." + h1))[1:]
-    lon = str(int(u_lon)) + str(float.fromhex("0." + h2))[1:]
-    return float(lat), float(lon)
+    `md5_digest` is the raw bytes from get_digest, or the hexadecimal string from get_hash.
+    """
+
+    if isinstance(md5_digest, str):
+        md5_digest = bytes.fromhex(md5_digest)
+    frac_lat, frac_lon = _digest_to_fractions(md5_digest)
+    return _assemble(frac_lat, frac_lon, u_lat, u_lon)
 
 
 def geohash(lat, lon, date=None, dow_jones=None, east=None):
@@ -83,14 +318,52 @@ def geohash(lat, lon, date=None, dow_jones=None, east=None):
         if lon > -30:
             east = True
     
-    return hash_to_location(lat, lon, get_hash(east, date, dow_jones))
+    frac_lat, frac_lon = _hash_to_fractions(*_resolve(east, date, dow_jones))
+    return _assemble(frac_lat, frac_lon, lat, lon)
+
+
 
+def geohash_many(lats, lons, date=None, dow_jones=None, east=None):
+    """Get xkcd geohashes for many positions on the same date at once.
+
+    `lats` and `lons` are array-likes of graticule coordinates, and the result is
+    a tuple of two NumPy arrays (lats, lons). Otherwise this works like geohash,
+    but the md5 hash is only computed once per side of 30W instead of per position.
+
+    NumPy is required for this function. If Numba is installed it's used as well.
+    """
+
+    import numpy as np
+
+    lats, lons = np.broadcast_arrays(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+    if date is None:
+        date = datetime.date.today()
+    if dow_jones is not None:
+        east = False  # Only affects which Dow Jones value is used
+    elif east is None:
+        east = lons > -30
+    east = np.broadcast_to(east, lons.shape)
+
+    frac_lat = np.empty(lons.shape)
+    frac_lon = np.empty(lons.shape)
+    for side in (False, True):
+        mask = east == side
+        if not mask.any():
+            continue
+        frac_lat[mask], frac_lon[mask] = _hash_to_fractions(*_resolve(side, date, dow_jones))
+
+    assemble_many = _jit_assemble_many()
+    if assemble_many is None:
+        return (np.copysign(np.abs(np.trunc(lats)) + frac_lat, lats),
+                np.copysign(np.abs(np.trunc(lons)) + frac_lon, lons))
+    assemble_many(lats.ravel(), lons.ravel(), frac_lat.ravel(), frac_lon.ravel())
+    return frac_lat, frac_lon
 
 
 def globalhash(date=None, dow_jones=None):
-    lat, lon = geohash(0, 0, date, dow_jones, east=True)
-    lat = lat * 180 - 90
-    lon = lon * 360 - 180
+    frac_lat, frac_lon = _hash_to_fractions(*_resolve(True, date, dow_jones))
+    lat = frac_lat * 180 - 90
+    lon = frac_lon * 360 - 180
     return lat, lon
 
 def replace_tenths(dst, src):
@@ -98,59 +371,85 @@ def replace_tenths(dst, src):
 
     new_tenths = int(abs(src) * 10) % 10
     old_tenths = int(abs(dst) * 10) % 10
-    dst = str(dst)
-    return float(dst.replace(f'.{old_tenths}', f'.{new_tenths}'))
+    return dst - math.copysign(1.0, dst) * (old_tenths - new_tenths) / 10
+
+# Map links for a (lat, lon) position
+_GMAP_URL = "https://www.google.com/maps/search/?api=1&query={},{}".format
+_OSM_URL = "https://www.openstreetmap.org/?mlat={}&mlon={}&zoom=10".format
+
+
+def print_fancy_output(lat, lon):
+    """Print the position in a readable form, with links to it on online maps."""
+
+    # Convert once, they're used several times
+    lat_s = str(lat)
+    lon_s = str(lon)
+    # Positive values are padded so they line up with negative signs
+    lat_pad = " " * (lat >= 0)
+    lon_pad = " " * (lon >= 0)
+    print(f"Latitude:  {lat_pad}{lat_s}\nLongitude: {lon_pad}{lon_s}")
+    print()
+    print("Google Maps:")
+    print("\t" + _GMAP_URL(lat_s, lon_s))
+    print("OpenStreetMap:")
+    print("\t" + _OSM_URL(lat_s, lon_s))
+
+# Format of the --date option, YYYY-MM-DD. Like strptime's %m and %d, single digits are allowed
+_DATE_RE = re.compile(r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})")
+
+# Values of the --30w option
+_EAST = ("e", "east")
+_WEST = ("w", "west")
 
 # TODO: Support finding in nearby graticules
 
-parser = argparse.ArgumentParser(description="Calculate geohashes as defined by Randall Munroe in xkcd #426.")
-parser.add_argument("latitude", type=float)
-parser.add_argument("longitude", type=float)
-parser.add_argument("-d", "--date", help="The geohash date in YYYY-MM-DD format. The current date is used otherwise.")
-parser.add_argument("-j", "--dow-jones", "--dj", type=float, help="The Dow Jones value, with two decimal places. The most recent compilant open value is used otherwise")
-parser.add_argument("--30w", choices=("e", "w", "east", "west"), help="Override automatic 30W detection, forcing either east or west.")
-parser.add_argument("-g", "--global", action="store_true", help="Calculate the globalhash instead. Lat and lon are ignored.")
-parser.add_argument("-s", "--simple", action="store_true", help="Only return lat and lon, separated by a newline.")
-parser.add_argument("--centicule", action="store_true", help="Calculate the centicule instead.")
-args = vars(parser.parse_args())
-
-# Checks
-if not args["date"] is None:
-    try:
-        args["date"] = datetime.datetime.strptime(args["date"], "%Y-%m-%d").date()
-    except ValueError:
-        print("The date provided was not in YYYY-MM-DD format.")
-        sys.exit(1)
-if args["30w"] in ["e", "east"]:
-    args["30w"] = True
-elif args["30w"] in ["w", "west"]:
-    args["30w"] = False
-
-if args["global"]:
-    lat, lon = globalhash(args["date"], args["dow_jones"])
-else:
-    lat, lon = geohash(args["latitude"], args["longitude"], args["date"], args["dow_jones"], args["30w"])
-
-if args["centicule"]:
-    # See https://geohashing.site/geohashing/Centicule
-    lat = replace_tenths(lat, args["latitude"])
-    lon = replace_tenths(lon, args["longitude"])
-
-if args["simple"]:
-    print(str(lat) + "\n" + str(lon))
-    sys.exit(0)
-
-# Fancy output
-if lat < 0:  # Pad negative sign
-    print("Latitude: ", lat)
-else:
-    print("Latitude:  ", lat)  # In line with longitude
-if lon < 0:
-    print("Longitude:", lon)
-else:
-    print("Longitude: ", lon)
-print()
-print("Google Maps:")
-print("\t" + "https://www.google.com/maps/search/?api=1&query=" + str(lat) + "," + str(lon))
-print("OpenStreetMap:")
-print("\t" + "https://www.openstreetmap.org/?mlat=" + str(lat) + "&mlon=" + str(lon) + "&zoom=10")
+
+def main():
+    parser = argparse.ArgumentParser(description="Calculate geohashes as defined by Randall Munroe in xkcd #426.")
+    parser.add_argument("latitude", type=float)
+    parser.add_argument("longitude", type=float)
+    parser.add_argument("-d", "--date", help="The geohash date in YYYY-MM-DD format. The current date is used otherwise.")
+    parser.add_argument("-j", "--dow-jones", "--dj", type=float, help="The Dow Jones value, with two decimal places. The most recent compilant open value is used otherwise")
+    parser.add_argument("--30w", choices=_EAST + _WEST, help="Override automatic 30W detection, forcing either east or west.")
+    parser.add_argument("-g", "--global", action="store_true", help="Calculate the globalhash instead. Lat and lon are ignored.")
+    parser.add_argument("-s", "--simple", action="store_true", help="Only return lat and lon, separated by a newline.")
+    parser.add_argument("--centicule", action="store_true", help="Calculate the centicule instead.")
+    args = vars(parser.parse_args())
+
+    # Checks
+    if not args["date"] is None:
+        try:
+            # fromisoformat also accepts other ISO 8601 forms in Python 3.11+, so check first
+            match = _DATE_RE.fullmatch(args["date"])
+            if match is None:
+                raise ValueError
+            year, month, day = match.groups()
+            args["date"] = datetime.date.fromisoformat(f"{year}-{month:0>2}-{day:0>2}")
+        except ValueError:
+            print("The date provided was not in YYYY-MM-DD format.")
+            sys.exit(1)
+    side = args["30w"]
+    if side in _EAST:
+        args["30w"] = True
+    elif side in _WEST:
+        args["30w"] = False
+
+    if args["global"]:
+        lat, lon = globalhash(args["date"], args["dow_jones"])
+    else:
+        lat, lon = geohash(args["latitude"], args["longitude"], args["date"], args["dow_jones"], args["30w"])
+
+    if args["centicule"]:
+        # See https://geohashing.site/geohashing/Centicule
+        lat = replace_tenths(lat, args["latitude"])
+        lon = replace_tenths(lon, args["longitude"])
+
+    if args["simple"]:
+        print(str(lat) + "\n" + str(lon))
+        return
+
+    print_fancy_output(lat, lon)
+
+
+if __name__ == "__main__":
+    main()